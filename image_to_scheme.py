@@ -1,11 +1,9 @@
 import tkinter as tk
 from tkinter import filedialog, ttk
 import threading
-from PIL import Image, ImageDraw, ImageFont
-import numpy as np
-from sklearn.cluster import KMeans
-import colorspacious
-from palette import rgb_to_dmc
+from PIL import Image
+from scheme_builder import (SchemeBuilder, SourceTooLargeError, write_stats,
+                            DEFAULT_MEMORY_BUDGET_MB, DEFAULT_FABRIC_COUNT)
 
 
 class ImagePixelizerApp:
@@ -58,22 +56,38 @@ class ImagePixelizerApp:
         self.color_count_entry = tk.Entry(root)
         self.color_count_entry.grid(row=4, column=1, padx=10, pady=10)
 
+        self.memory_budget_label = tk.Label(root, text="Memory Budget (MB):")
+        self.memory_budget_label.grid(row=5, column=0, padx=10, pady=10)
+
+        # Поле для ограничения памяти под промежуточные данные
+        self.memory_budget_entry = tk.Entry(root)
+        self.memory_budget_entry.insert(0, str(DEFAULT_MEMORY_BUDGET_MB))
+        self.memory_budget_entry.grid(row=5, column=1, padx=10, pady=10)
+
+        self.fabric_count_label = tk.Label(root, text="Fabric Count:")
+        self.fabric_count_label.grid(row=6, column=0, padx=10, pady=10)
+
+        # Поле плотности канвы для оценки расхода мулине
+        self.fabric_count_entry = tk.Entry(root)
+        self.fabric_count_entry.insert(0, str(DEFAULT_FABRIC_COUNT))
+        self.fabric_count_entry.grid(row=6, column=1, padx=10, pady=10)
+
         self.pixelize_button = tk.Button(
             root, text="Make a Scheme", command=self.start_pixelize_thread)
-        self.pixelize_button.grid(row=5, column=0, padx=10, pady=10)
+        self.pixelize_button.grid(row=7, column=0, padx=10, pady=10)
 
         self.cancel_button = tk.Button(
             root, text="Cancel", command=self.cancel_pixelize_thread, state="disabled")
-        self.cancel_button.grid(row=5, column=1, padx=10, pady=10)
+        self.cancel_button.grid(row=7, column=1, padx=10, pady=10)
 
         # Индикатор прогресса
         self.progress_bar = ttk.Progressbar(
             root, orient="horizontal", mode="determinate", maximum=100, length=300)
-        self.progress_bar.grid(row=6, columnspan=2, padx=10, pady=10)
+        self.progress_bar.grid(row=8, columnspan=2, padx=10, pady=10)
 
         # Подпись для прогрессбара
         self.progress_label = tk.Label(root, text="")
-        self.progress_label.grid(row=7, columnspan=2)
+        self.progress_label.grid(row=9, columnspan=2)
 
         # Переменные для хранения данных
         self.input_image_path = None
@@ -128,7 +142,8 @@ class ImagePixelizerApp:
         '''Метод для блокировки или разблокировки элементов управления'''
         for widget in [self.input_image_button, self.pixel_size_dropdown,
                        self.width_entry, self.height_entry,
-                       self.color_count_entry, self.pixelize_button]:
+                       self.color_count_entry, self.memory_budget_entry,
+                       self.fabric_count_entry, self.pixelize_button]:
             widget.configure(state=state)
 
     def start_pixelize_thread(self):
@@ -182,99 +197,35 @@ class ImagePixelizerApp:
             output_height = int(self.height_entry.get())
             color_count = int(self.color_count_entry.get())
 
-            num_pallette = []
-
             if not self.input_image_path:
                 print("Please choose an input image.")
                 return
 
-            input_image = Image.open(self.input_image_path)
-            input_image = input_image.resize((output_width, output_height))
-
-            # Преобразование изображения в массив numpy
-            img_array = np.array(input_image)
-
-            # Вычисление количества линий сетки
-            grid_width = output_width // self.pixel_size
-            grid_height = output_height // self.pixel_size
-
-            # Выполнение кластеризации цветов
-            # Преобразование в двумерный массив
-            reshaped_array = img_array.reshape((-1, 3))
-            kmeans = KMeans(n_clusters=color_count,
-                            random_state=0).fit(reshaped_array)
-
-            # Получение центров кластеров (представительные цвета)
-            representative_colors = kmeans.cluster_centers_.astype(int)
-
-            # Создание палитры в формате RGB
-            self.palette = [tuple(color) for color in representative_colors]
-
-            # Создание выходного изображения
-            output_image = Image.new('RGB', (output_width, output_height))
-
-            # Замена цветов пикселей на ближайшие из палитры DMC
-            total_pixels = grid_width * grid_height
-            processed_pixels = 0
-            for y in range(0, input_image.size[1], self.pixel_size):
-                for x in range(0, input_image.size[0], self.pixel_size):
-                    # Проверяем флаг отмены
-                    if self.cancel_flag:
-                        # Прерываем выполнение и сбрасываем флаг, если он установлен в True
-                        self.cancel_flag = False
-                        return
-                    pixel = tuple(
-                        np.mean(img_array[y:y+self.pixel_size, x:x+self.pixel_size],
-                                axis=(0, 1)).astype(int))
-                    closest_color = self.find_closest_color(pixel)
-                    closest_color = min(rgb_to_dmc, key=lambda c: np.linalg.norm(
-                        np.array(closest_color) - np.array(c)))  # Замена цвета на ближайший из палитры DMC
-                    if closest_color:
-                        for i in range(self.pixel_size):
-                            for j in range(self.pixel_size):
-                                output_image.putpixel(
-                                    (x + i, y + j), closest_color)
-                    processed_pixels += 1
-                    progress_percentage = (
-                        processed_pixels / total_pixels) * 100
-                    self.update_progress(progress_percentage)
-
-            draw = ImageDraw.Draw(output_image)
-
-            for y in range(0, input_image.size[1], self.pixel_size):
-                for x in range(0, input_image.size[0], self.pixel_size):
-                    pixel = tuple(
-                        np.mean(img_array[y:y + self.pixel_size, x:x + self.pixel_size], axis=(0, 1)).astype(int))
-                    closest_color = self.find_closest_color(pixel)
-                    closest_color = min(rgb_to_dmc, key=lambda c: np.linalg.norm(
-                        np.array(closest_color) - np.array(c)))
-                    dmc_color = rgb_to_dmc[closest_color]
-                    if closest_color not in num_pallette:
-                        num_pallette.append(closest_color)
-                    if dmc_color:
-                        draw.rectangle(
-                            [(x, y), (x + self.pixel_size, y + self.pixel_size)],
-                            fill=tuple(closest_color))
-                    draw.text((x+2, y+2), str(num_pallette.index(closest_color)),
-                              fill="white", font=ImageFont.truetype("arial.ttf", self.pixel_size//2))
-
-            for x in range(0, output_width, self.pixel_size):
-                draw.line([(x, 0), (x, output_height)],
-                          fill='black', width=1)
-            for y in range(0, output_height, self.pixel_size):
-                draw.line([(0, y), (output_width, y)],
-                          fill='black', width=1)
-
-            legend = Image.new('RGB', (color_count * 50, 50), 'white')
-            legend_draw = ImageDraw.Draw(legend)
-            for i, color in enumerate(num_pallette):
-                legend_draw.rectangle(
-                    [(i * 50, 0), (i * 50 + 50, 50)], fill=tuple(color))
-                legend_draw.text(
-                    (i * 50 + 5, 5), f"{i}\nDMC:{rgb_to_dmc[color]}", fill=(0, 255, 0), font=ImageFont.truetype("arial.ttf", 10))
+            builder = SchemeBuilder(
+                pixel_size=self.pixel_size,
+                memory_budget_mb=self.get_memory_budget(),
+                fabric_count=self.get_fabric_count(),
+                progress_callback=self.update_progress,
+                cancel_check=lambda: self.cancel_flag)
+
+            try:
+                with Image.open(self.input_image_path) as input_image:
+                    result = builder.build(
+                        input_image, output_width, output_height, color_count)
+            except SourceTooLargeError:
+                print("The input image does not fit the memory budget.")
+                return
+            self.palette = builder.palette
+
+            if result is None:
+                # Сбрасываем флаг отмены после прерывания генерации
+                self.cancel_flag = False
+                return
+            output_image, legend, stats = result
 
             self.save_image(output_image)
             self.save_image(legend)
+            self.save_stats(stats)
         finally:
             # Блокировка кнопки "Cancel"
             self.cancel_button.configure(state="disabled")
@@ -287,27 +238,19 @@ class ImagePixelizerApp:
 
             self.progress_label.config(text="")
 
-    def find_closest_color(self, rgb_color):
-        '''Метод, определяющий ближайший цвет из палитры'''
-        if self.palette is None:
-            return None
-
-        min_distance = float('inf')
-        closest_color = None
-
-        for color in self.palette:
-            distance = self.calculate_distance(rgb_color, color)
-            if distance < min_distance:
-                min_distance = distance
-                closest_color = color
-
-        return closest_color
+    def get_memory_budget(self):
+        '''Метод, возвращающий бюджет памяти в мегабайтах из соответствующего поля'''
+        try:
+            return int(self.memory_budget_entry.get())
+        except ValueError:
+            return DEFAULT_MEMORY_BUDGET_MB
 
-    def calculate_distance(self, rgb1, rgb2):
-        '''Метод, определяющий что-то '''
-        lab1 = colorspacious.cspace_convert(rgb1, "sRGB255", "CAM02-UCS")
-        lab2 = colorspacious.cspace_convert(rgb2, "sRGB255", "CAM02-UCS")
-        return np.linalg.norm(lab1 - lab2)
+    def get_fabric_count(self):
+        '''Метод, возвращающий плотность канвы (крестиков на дюйм) из соответствующего поля'''
+        try:
+            return int(self.fabric_count_entry.get())
+        except ValueError:
+            return DEFAULT_FABRIC_COUNT
 
     def update_pixel_size(self):
         '''Метод для обновления переменной размерности пикселя'''
@@ -318,6 +261,14 @@ class ImagePixelizerApp:
             # Если размер не выбран, устанавливаем значение по умолчанию, равное 1
             self.pixel_size = 1
 
+    def save_stats(self, stats):
+        '''Метод для сохранения статистики расхода мулине в CSV'''
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".csv", filetypes=[("CSV files", "*.csv"), ("All files", "*.*")])
+        if file_path:
+            with open(file_path, 'w', newline='', encoding='utf-8') as stats_file:
+                write_stats(stats, stats_file)
+
     def save_image(self, output_image):
         '''Метод для сохранения изображения'''
         # Запрашиваем у пользователя путь для сохранения файла
@@ -0,0 +1,360 @@
+"""Локальный HTTP-сервис построения схем с пулом заранее прогретых процессов
+
+Запуск: python render_service.py --port 8765 --workers 2 --memory-budget 256
+
+POST /scheme?width=..&height=..&colors=..[&pixel_size=..&fabric_count=..]
+    тело запроса — файл изображения; ответ — JSON со схемой и легендой (PNG в base64),
+    статистикой расхода мулине и той же статистикой в виде CSV
+GET /status
+    глубина очереди, число выполняемых задач и перцентили времени обработки
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from PIL import Image
+from scheme_builder import (SchemeBuilder, SourceTooLargeError, write_stats,
+                            DEFAULT_MEMORY_BUDGET_MB, DEFAULT_FABRIC_COUNT)
+
+# Число последних задач, по которым считаются перцентили времени обработки
+LATENCY_WINDOW = 1000
+# Ограничение на размер загружаемого изображения
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+# Ограничения по умолчанию на размер схемы, число цветов и размер исходника
+DEFAULT_MAX_PIXELS = 4000 * 4000
+DEFAULT_MAX_COLORS = 256
+DEFAULT_MAX_SOURCE_PIXELS = 50_000_000
+
+
+def warm_worker():
+    '''Функция инициализации процесса: прогрев библиотек и палитры DMC'''
+    # Импорт модуля уже подтянул scikit-learn, colorspacious и индекс палитры DMC;
+    # пробная генерация на крошечном изображении подгружает ленивые модули
+    builder = SchemeBuilder(pixel_size=2)
+    builder.build(Image.new('RGB', (4, 4), 'white'), 4, 4, 1)
+
+
+def render_job(image_bytes, params, memory_budget_mb, max_source_pixels):
+    '''Функция, выполняемая в рабочем процессе: строит схему по байтам изображения'''
+    builder = SchemeBuilder(
+        pixel_size=params['pixel_size'],
+        memory_budget_mb=memory_budget_mb,
+        fabric_count=params['fabric_count'])
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as input_image:
+            # Размер известен из заголовка, до раскодирования пикселей
+            source_width, source_height = input_image.size
+            if source_width * source_height > max_source_pixels:
+                raise InvalidImageError("source image is too large")
+            output_image, legend, stats = builder.build(
+                input_image, params['width'], params['height'], params['colors'])
+    except (OSError, Image.DecompressionBombError, SourceTooLargeError) as error:
+        # Нераспознанный, обрезанный или слишком большой файл — ошибка клиента
+        raise InvalidImageError(f"cannot read image: {error}")
+
+    images = {}
+    for name, image in (('scheme', output_image), ('legend', legend)):
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        images[name] = buffer.getvalue()
+
+    stats_csv = io.StringIO()
+    write_stats(stats, stats_csv)
+
+    return {
+        'scheme': images['scheme'],
+        'legend': images['legend'],
+        'stats': [dict(row._asdict(), rgb=list(row.rgb)) for row in stats],
+        'stats_csv': stats_csv.getvalue(),
+    }
+
+
+class QueueFullError(Exception):
+    '''Исключение, возникающее при переполнении очереди задач'''
+
+
+class InvalidImageError(Exception):
+    '''Исключение, возникающее при непригодном для обработки изображении'''
+
+
+class RenderService:
+    '''Класс, управляющий пулом рабочих процессов, очередью задач и метриками'''
+
+    def __init__(self, workers=None, max_queue=16,
+                 memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                 max_pixels=DEFAULT_MAX_PIXELS, max_colors=DEFAULT_MAX_COLORS,
+                 max_source_pixels=DEFAULT_MAX_SOURCE_PIXELS):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        if self.workers < 1:
+            raise ValueError("workers must be positive")
+        if max_queue < 0:
+            raise ValueError("max_queue must not be negative")
+
+        # Ограничения задаются оператором сервиса, а не клиентом
+        self.memory_budget_mb = memory_budget_mb
+        self.max_pixels = max_pixels
+        self.max_colors = max_colors
+        self.max_source_pixels = max_source_pixels
+
+        # Одновременно принимается не больше задач, чем процессов плюс длина очереди
+        self.slots = threading.BoundedSemaphore(self.workers + max_queue)
+        self.executor = self.create_executor()
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.pool_restarts = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def create_executor(self):
+        '''Метод, создающий пул рабочих процессов с прогревом при запуске'''
+        return ProcessPoolExecutor(
+            max_workers=self.workers, initializer=warm_worker)
+
+    def warm_up(self, executor=None):
+        '''Метод, запускающий все рабочие процессы заранее, до первого запроса'''
+        executor = executor or self.executor
+        # Пул создаёт процессы лениво, поэтому отправляем по пустой задаче на каждый
+        futures = [executor.submit(time.sleep, 0)
+                   for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+
+    @contextmanager
+    def slot(self):
+        '''Контекстный менеджер, занимающий место в очереди или отклоняющий задачу'''
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise QueueFullError("render queue is full")
+
+        with self.lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def render(self, image_bytes, params):
+        '''Метод, выполняющий задачу в пуле; вызывается внутри занятого slot()'''
+        started = time.perf_counter()
+        job = (render_job, image_bytes, params, self.memory_budget_mb,
+               self.max_source_pixels)
+        executor = self.executor
+        try:
+            future = executor.submit(*job)
+        except BrokenProcessPool:
+            # Пул сломался до этой задачи, и она не начиналась:
+            # заменяем пул и отправляем задачу ещё раз
+            self.restart_pool(executor)
+            executor = self.executor
+            future = executor.submit(*job)
+        try:
+            result = future.result()
+        except BrokenProcessPool:
+            # Задача выполнялась в момент гибели рабочего процесса
+            with self.lock:
+                self.failed += 1
+            self.restart_pool(executor)
+            raise
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+        with self.lock:
+            self.completed += 1
+            self.latencies.append(time.perf_counter() - started)
+        return result
+
+    def restart_pool(self, broken_executor):
+        '''Метод, заменяющий сломанный пул (например, после гибели процесса) новым'''
+        with self.lock:
+            # Пул мог уже заменить другой запрос, упавший вместе с этим
+            if self.executor is not broken_executor:
+                return
+            self.executor = self.create_executor()
+            self.pool_restarts += 1
+            executor = self.executor
+        broken_executor.shutdown(wait=False, cancel_futures=True)
+        self.warm_up(executor)
+
+    def status(self):
+        '''Метод, возвращающий состояние очереди и перцентили времени обработки'''
+        with self.lock:
+            in_flight = self.in_flight
+            latencies = sorted(self.latencies)
+            status = {
+                'workers': self.workers,
+                'in_flight': in_flight,
+                'queue_depth': max(0, in_flight - self.workers),
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'pool_restarts': self.pool_restarts,
+            }
+
+        for name, percentile in (('p50', 50), ('p90', 90), ('p99', 99)):
+            if latencies:
+                # Перцентиль по методу ближайшего ранга
+                rank = max(0, -(-percentile * len(latencies) // 100) - 1)
+                status[f'latency_{name}_ms'] = round(latencies[rank] * 1000, 1)
+            else:
+                status[f'latency_{name}_ms'] = None
+        return status
+
+    def shutdown(self):
+        '''Метод, останавливающий пул рабочих процессов'''
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def parse_params(query, max_pixels=DEFAULT_MAX_PIXELS,
+                 max_colors=DEFAULT_MAX_COLORS):
+    '''Функция, разбирающая и проверяющая параметры задачи из строки запроса'''
+    values = parse_qs(query)
+    defaults = {'pixel_size': 1, 'fabric_count': DEFAULT_FABRIC_COUNT}
+
+    params = {}
+    for name in ('width', 'height', 'colors', 'pixel_size', 'fabric_count'):
+        if name in values:
+            try:
+                params[name] = int(values[name][0])
+            except ValueError:
+                raise ValueError(f"parameter '{name}' must be an integer")
+        elif name in defaults:
+            params[name] = defaults[name]
+        else:
+            raise ValueError(f"parameter '{name}' is required")
+        if params[name] < 1:
+            raise ValueError(f"parameter '{name}' must be positive")
+
+    if params['width'] * params['height'] > max_pixels:
+        raise ValueError(f"'width' * 'height' must not exceed {max_pixels}")
+    if params['colors'] > max_colors:
+        raise ValueError(f"'colors' must not exceed {max_colors}")
+    if params['colors'] > params['width'] * params['height']:
+        raise ValueError("'colors' must not exceed the number of pixels")
+    return params
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    '''Обработчик HTTP-запросов к сервису построения схем'''
+
+    # Экземпляр RenderService, общий для всех запросов
+    service = None
+
+    def do_GET(self):
+        '''Метод, обрабатывающий запрос состояния сервиса'''
+        if urlparse(self.path).path != '/status':
+            self.send_json(404, {'error': 'not found'})
+            return
+        self.send_json(200, self.service.status())
+
+    def do_POST(self):
+        '''Метод, обрабатывающий запрос на построение схемы'''
+        url = urlparse(self.path)
+        if url.path != '/scheme':
+            self.send_json(404, {'error': 'not found'})
+            return
+
+        try:
+            params = parse_params(
+                url.query, self.service.max_pixels, self.service.max_colors)
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        if not 0 < length <= MAX_UPLOAD_BYTES:
+            self.send_json(400, {'error': 'image body is missing or too large'})
+            return
+
+        try:
+            # Место в очереди занимается до чтения тела, чтобы не буферизовать
+            # загрузки, которые всё равно будут отклонены
+            with self.service.slot():
+                image_bytes = self.rfile.read(length)
+                result = self.service.render(image_bytes, params)
+        except QueueFullError as error:
+            self.send_json(503, {'error': str(error)})
+            return
+        except InvalidImageError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        except Exception as error:
+            self.send_json(500, {'error': f"render failed: {error}"})
+            return
+
+        result['scheme'] = base64.b64encode(result['scheme']).decode('ascii')
+        result['legend'] = base64.b64encode(result['legend']).decode('ascii')
+        self.send_json(200, result)
+
+    def send_json(self, code, payload):
+        '''Метод, отправляющий ответ в формате JSON'''
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    '''Точка входа: разбор аргументов командной строки и запуск сервера'''
+    parser = argparse.ArgumentParser(description="Stitch scheme render service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument('--max-queue', type=int, default=16,
+                        help="jobs allowed to wait for a free worker")
+    parser.add_argument('--memory-budget', type=int, default=DEFAULT_MEMORY_BUDGET_MB,
+                        help="memory budget per job in MB")
+    parser.add_argument('--max-pixels', type=int, default=DEFAULT_MAX_PIXELS,
+                        help="largest allowed width * height of a scheme")
+    parser.add_argument('--max-colors', type=int, default=DEFAULT_MAX_COLORS,
+                        help="largest allowed number of colours")
+    parser.add_argument('--max-source-pixels', type=int, default=DEFAULT_MAX_SOURCE_PIXELS,
+                        help="largest allowed width * height of an uploaded image")
+    args = parser.parse_args()
+
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.max_queue < 0:
+        parser.error("--max-queue must not be negative")
+    for name in ('memory_budget', 'max_pixels', 'max_colors', 'max_source_pixels'):
+        if getattr(args, name) < 1:
+            parser.error(f"--{name.replace('_', '-')} must be at least 1")
+
+    service = RenderService(
+        workers=args.workers, max_queue=args.max_queue,
+        memory_budget_mb=args.memory_budget, max_pixels=args.max_pixels,
+        max_colors=args.max_colors, max_source_pixels=args.max_source_pixels)
+    service.warm_up()
+    RenderRequestHandler.service = service
+
+    server = ThreadingHTTPServer((args.host, args.port), RenderRequestHandler)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
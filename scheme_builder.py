@@ -0,0 +1,328 @@
+"""Файл с конвейером построения схемы вышивки, не зависящим от интерфейса"""
+
+import csv
+from collections import namedtuple
+from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from sklearn.cluster import KMeans
+import colorspacious
+from palette import rgb_to_dmc
+
+# Бюджет памяти по умолчанию (в мегабайтах) для промежуточных данных генерации
+DEFAULT_MEMORY_BUDGET_MB = 256
+
+# Плотность канвы по умолчанию (Aida 14, крестиков на дюйм)
+DEFAULT_FABRIC_COUNT = 14
+# Пасма мулине DMC: 8 метров из 6 сложений, вышивка ведётся в 2 сложения
+SKEIN_LENGTH_MM = 8000
+SKEIN_STRANDS = 6
+STITCH_STRANDS = 2
+# Запас нити на закрепки и переходы между участками
+THREAD_WASTE_FACTOR = 1.2
+
+# Размеры легенды: число столбцов и размер ячейки одного цвета
+LEGEND_COLUMNS = 5
+LEGEND_CELL_WIDTH = 160
+LEGEND_CELL_HEIGHT = 50
+
+# Статистика по одному цвету схемы: номер, код DMC, RGB, число крестиков и расход пасм
+ThreadStats = namedtuple(
+    'ThreadStats', ['index', 'dmc', 'rgb', 'stitches', 'skeins', 'skeins_to_buy'])
+
+# Память KMeans, не зависящая от числа пикселей выборки
+KMEANS_FIXED_BYTES = 256 * 1024
+
+# Режимы, которые Image.reduce уменьшает без преобразования в RGB
+REDUCIBLE_MODES = ('L', 'LA', 'RGB', 'RGBA')
+
+# Индекс палитры DMC, строится один раз при импорте модуля
+DMC_COLORS = list(rgb_to_dmc)
+DMC_ARRAY = np.array(DMC_COLORS, dtype=np.float32)
+
+
+class SourceTooLargeError(Exception):
+    '''Исключение, возникающее, когда раскодирование исходника не помещается в бюджет памяти'''
+
+
+def load_font(size):
+    '''Функция, загружающая шрифт Arial, а при его отсутствии — стандартный шрифт PIL'''
+    size = max(size, 1)
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except OSError:
+        return ImageFont.load_default(size=size)
+
+
+def closest_dmc_color(rgb_color):
+    '''Функция, возвращающая ближайший (по RGB) цвет из палитры DMC'''
+    distances = ((DMC_ARRAY - np.asarray(rgb_color, dtype=np.float32)) ** 2).sum(axis=1)
+    return DMC_COLORS[int(np.argmin(distances))]
+
+
+def contrast_text_color(rgb_color):
+    '''Функция, выбирающая чёрный или белый текст по яркости цвета фона'''
+    red, green, blue = rgb_color
+    # Яркость по весам Rec. 601
+    luminance = 0.299 * red + 0.587 * green + 0.114 * blue
+    return 'black' if luminance > 128 else 'white'
+
+
+def write_stats(stats, stats_file):
+    '''Функция, записывающая статистику расхода мулине в открытый файл в формате CSV'''
+    writer = csv.writer(stats_file)
+    writer.writerow(ThreadStats._fields)
+    for row in stats:
+        writer.writerow(row._replace(rgb='#%02x%02x%02x' % tuple(row.rgb),
+                                     skeins=f"{row.skeins:.3f}"))
+
+
+class SchemeBuilder:
+    '''Класс, строящий схему вышивки, её легенду и статистику по исходному изображению'''
+
+    def __init__(self, pixel_size=1, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                 fabric_count=DEFAULT_FABRIC_COUNT, progress_callback=None,
+                 cancel_check=None):
+        self.pixel_size = max(pixel_size, 1)
+        self.memory_budget = max(memory_budget_mb, 1) * 1024 * 1024
+        self.fabric_count = max(fabric_count, 1)
+        # Необязательные обработчики прогресса и проверки отмены
+        self.progress_callback = progress_callback
+        self.cancel_check = cancel_check
+
+        self.palette = None
+        # Значения палитры в пространстве CAM02-UCS, считаются один раз на палитру
+        self.palette_ucs = None
+
+    def build(self, input_image, output_width, output_height, color_count):
+        '''Метод, возвращающий схему, легенду и статистику либо None при отмене'''
+        resized_image = self.load_source(
+            input_image, output_width, output_height)
+
+        # Преобразование изображения в массив numpy без повышения разрядности
+        img_array = np.asarray(resized_image, dtype=np.uint8)
+        resized_image.close()
+        del resized_image
+
+        # Выполнение кластеризации цветов и создание палитры в формате RGB
+        self.set_palette(self.fit_palette(img_array, color_count))
+
+        # Средние цвета ячеек сетки; сам массив пикселей больше не нужен
+        cell_colors = self.compute_cell_colors(img_array)
+        del img_array
+
+        result = self.label_cells(cell_colors)
+        del cell_colors
+        if result is None:
+            return None
+        labels, num_pallette = result
+
+        output_image = self.draw_scheme(
+            labels, num_pallette, output_width, output_height)
+        stats = self.compute_thread_stats(labels, num_pallette)
+        return output_image, self.build_legend(stats), stats
+
+    def load_source(self, input_image, output_width, output_height):
+        '''Метод, уменьшающий исходник до размера схемы и сразу освобождающий его'''
+        # Для JPEG декодируем сразу в уменьшенном масштабе, не раскрывая исходник целиком
+        input_image.draft('RGB', (output_width, output_height))
+        source_width, source_height = input_image.size
+
+        # PIL хранит до 4 байт на пиксель; остальные режимы (например, палитровый)
+        # перед уменьшением приходится преобразовывать в RGB в полном размере
+        reducible = input_image.mode in REDUCIBLE_MODES
+        source_bytes = source_width * source_height * 4 * (1 if reducible else 2)
+        if source_bytes > self.memory_budget:
+            raise SourceTooLargeError(
+                f"decoding a {source_width}x{source_height} image exceeds the memory budget")
+
+        try:
+            image = input_image if reducible else input_image.convert('RGB')
+            # Целочисленное уменьшение до размера не меньше схемы, без полноразмерной копии
+            factor = min(source_width // output_width,
+                         source_height // output_height)
+            if factor > 1:
+                image = image.reduce(factor)
+            return image.convert('RGB').resize((output_width, output_height))
+        finally:
+            # Раскодированный исходник больше не нужен
+            input_image.close()
+
+    def set_palette(self, palette):
+        '''Метод, устанавливающий палитру кластеров и её представление в CAM02-UCS'''
+        self.palette = palette
+        self.palette_ucs = colorspacious.cspace_convert(
+            np.array(palette, dtype=float), "sRGB255", "CAM02-UCS")
+
+    def fit_palette(self, img_array, color_count):
+        '''Метод, подбирающий палитру кластеризацией цветов в рамках бюджета памяти'''
+        pixels = img_array.reshape((-1, 3))
+
+        # Число кандидатов на каждом шаге инициализации k-means++ (как в scikit-learn)
+        n_local_trials = 2 + int(np.log(color_count))
+        # Байт на пиксель выборки: сама выборка (uint8) и её float32-копия,
+        # центрированная копия KMeans (copy_x), веса, квадраты норм и расстояния
+        # k-means++, расстояния до кандидатов и до центров, три массива меток
+        bytes_per_sample = (3 + 3 * 4 + 3 * 4 + 3 * 4 + n_local_trials * 4
+                            + color_count * 4 + 3 * 4)
+        # Постоянная часть: буферы потоков, центры и служебные структуры
+        sample_budget = max(self.memory_budget - KMEANS_FIXED_BYTES, 0)
+        max_samples = max(color_count, sample_budget // bytes_per_sample)
+
+        # Если все пиксели в бюджет не помещаются, кластеризуем случайную выборку
+        if len(pixels) > max_samples:
+            rng = np.random.default_rng(0)
+            pixels = pixels[rng.integers(0, len(pixels), size=max_samples)]
+
+        samples = pixels.astype(np.float32)
+        kmeans = KMeans(n_clusters=color_count, random_state=0).fit(samples)
+        del samples
+
+        # Получение центров кластеров (представительные цвета)
+        representative_colors = kmeans.cluster_centers_.astype(int)
+        del kmeans
+        return [tuple(color) for color in representative_colors]
+
+    def compute_cell_colors(self, img_array):
+        '''Метод, усредняющий цвета ячеек сетки по горизонтальным полосам'''
+        height, width = img_array.shape[:2]
+        row_starts = np.arange(0, height, self.pixel_size)
+        col_starts = np.arange(0, width, self.pixel_size)
+
+        # Количество пикселей в ячейке по каждой оси (крайние ячейки могут быть неполными)
+        row_counts = np.diff(np.append(row_starts, height)).astype(np.float32)
+        col_counts = np.diff(np.append(col_starts, width)).astype(np.float32)
+        cell_areas = row_counts[:, None, None] * col_counts[None, :, None]
+
+        cell_colors = np.empty(
+            (len(row_starts), len(col_starts), 3), dtype=np.uint8)
+
+        # Каждая строка ячеек даёт промежуточную строку сумм во float32
+        rows_per_band = max(1, self.memory_budget // (width * 3 * 4))
+        for start in range(0, len(row_starts), rows_per_band):
+            stop = min(start + rows_per_band, len(row_starts))
+            top = row_starts[start]
+            bottom = row_starts[stop] if stop < len(row_starts) else height
+
+            sums = np.add.reduceat(
+                img_array[top:bottom], row_starts[start:stop] - top,
+                axis=0, dtype=np.float32)
+            sums = np.add.reduceat(sums, col_starts, axis=1)
+            sums /= cell_areas[start:stop]
+
+            # Отбрасывание дробной части, как и при приведении к int
+            cell_colors[start:stop] = sums.astype(np.uint8)
+            del sums
+
+        return cell_colors
+
+    def label_cells(self, cell_colors):
+        '''Метод, сопоставляющий каждой ячейке номер цвета DMC на схеме'''
+        # Сетка меток: номер цвета схемы для каждой ячейки
+        labels = np.empty(cell_colors.shape[:2], dtype=np.uint16)
+        label_index = {}
+        num_pallette = []
+        # Одинаковые ячейки сопоставляются с DMC только один раз
+        dmc_cache = {}
+
+        # Замена цветов пикселей на ближайшие из палитры DMC
+        total_pixels = labels.size
+        processed_pixels = 0
+        for row in range(labels.shape[0]):
+            # Проверяем флаг отмены
+            if self.cancel_check is not None and self.cancel_check():
+                return None
+            for col in range(labels.shape[1]):
+                pixel = tuple(int(c) for c in cell_colors[row, col])
+                closest_color = dmc_cache.get(pixel)
+                if closest_color is None:
+                    closest_color = closest_dmc_color(
+                        self.find_closest_color(pixel))
+                    dmc_cache[pixel] = closest_color
+                # Цвета нумеруются в порядке первого появления на схеме
+                if closest_color not in label_index:
+                    label_index[closest_color] = len(num_pallette)
+                    num_pallette.append(closest_color)
+                labels[row, col] = label_index[closest_color]
+            processed_pixels += labels.shape[1]
+            if self.progress_callback is not None:
+                self.progress_callback(processed_pixels / total_pixels * 100)
+
+        return labels, num_pallette
+
+    def draw_scheme(self, labels, num_pallette, output_width, output_height):
+        '''Метод, рисующий схему с номерами цветов и сеткой по сетке меток'''
+        output_image = Image.new('RGB', (output_width, output_height))
+        draw = ImageDraw.Draw(output_image)
+        font = load_font(self.pixel_size//2)
+
+        for row, y in enumerate(range(0, output_height, self.pixel_size)):
+            for col, x in enumerate(range(0, output_width, self.pixel_size)):
+                label = int(labels[row, col])
+                draw.rectangle(
+                    [(x, y), (x + self.pixel_size, y + self.pixel_size)],
+                    fill=tuple(num_pallette[label]))
+                draw.text((x+2, y+2), str(label), fill="white", font=font)
+
+        for x in range(0, output_width, self.pixel_size):
+            draw.line([(x, 0), (x, output_height)],
+                      fill='black', width=1)
+        for y in range(0, output_height, self.pixel_size):
+            draw.line([(0, y), (output_width, y)],
+                      fill='black', width=1)
+
+        return output_image
+
+    def compute_thread_stats(self, labels, num_pallette):
+        '''Метод, подсчитывающий число крестиков и расход мулине для каждого цвета схемы'''
+        # Один проход по сетке меток
+        stitch_counts = np.bincount(labels.ravel(), minlength=len(num_pallette))
+
+        # Нить на крестик: две диагонали и два перехода по изнанке
+        stitch_size_mm = 25.4 / self.fabric_count
+        thread_per_stitch_mm = (2 * np.sqrt(2) + 2) * \
+            stitch_size_mm * THREAD_WASTE_FACTOR
+        skein_thread_mm = SKEIN_LENGTH_MM * SKEIN_STRANDS / STITCH_STRANDS
+        skein_usage = stitch_counts * thread_per_stitch_mm / skein_thread_mm
+
+        return [ThreadStats(index=i, dmc=rgb_to_dmc[color], rgb=color,
+                            stitches=int(stitch_counts[i]),
+                            skeins=float(skein_usage[i]),
+                            skeins_to_buy=int(np.ceil(skein_usage[i])))
+                for i, color in enumerate(num_pallette)]
+
+    def build_legend(self, stats):
+        '''Метод, строящий легенду схемы в виде таблицы из нескольких строк'''
+        columns = max(1, min(len(stats), LEGEND_COLUMNS))
+        rows = max(1, -(-len(stats) // columns))
+
+        legend = Image.new('RGB', (columns * LEGEND_CELL_WIDTH,
+                                   rows * LEGEND_CELL_HEIGHT), 'white')
+        legend_draw = ImageDraw.Draw(legend)
+        font = load_font(10)
+        swatch = LEGEND_CELL_HEIGHT - 10
+
+        for row in stats:
+            x = (row.index % columns) * LEGEND_CELL_WIDTH + 5
+            y = (row.index // columns) * LEGEND_CELL_HEIGHT + 5
+            # Образец цвета с номером, как на схеме
+            legend_draw.rectangle(
+                [(x, y), (x + swatch, y + swatch)], fill=tuple(row.rgb), outline='black')
+            legend_draw.text((x + 3, y + 3), str(row.index),
+                             fill=contrast_text_color(row.rgb), font=font)
+            legend_draw.text(
+                (x + swatch + 5, y),
+                f"DMC: {row.dmc}\n{row.stitches} st.\n"
+                f"{row.skeins:.2f} sk. (buy {row.skeins_to_buy})",
+                fill='black', font=font)
+
+        return legend
+
+    def find_closest_color(self, rgb_color):
+        '''Метод, определяющий ближайший цвет из палитры'''
+        if self.palette is None:
+            return None
+
+        # Расстояния до всех цветов палитры в пространстве CAM02-UCS
+        lab = colorspacious.cspace_convert(rgb_color, "sRGB255", "CAM02-UCS")
+        distances = np.linalg.norm(self.palette_ucs - lab, axis=1)
+        return self.palette[int(np.argmin(distances))]
@@ -0,0 +1,127 @@
+import base64
+import io
+import json
+import os
+import struct
+import threading
+import urllib.error
+import urllib.request
+import zlib
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from render_service import RenderRequestHandler, RenderService
+
+
+@pytest.fixture(scope='module')
+def server():
+    '''Сервис с одним рабочим процессом и без очереди на свободном порту localhost'''
+    service = RenderService(workers=1, max_queue=0, memory_budget_mb=16,
+                            max_pixels=10_000, max_colors=32,
+                            max_source_pixels=1_000_000)
+    service.warm_up()
+    RenderRequestHandler.service = service
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RenderRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield service, f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    httpd.shutdown()
+    httpd.server_close()
+    service.shutdown()
+
+
+def png_bytes(width=20, height=20):
+    '''Небольшое градиентное изображение в формате PNG'''
+    gradient = np.linspace(0, 255, width * height * 3).reshape(height, width, 3)
+    buffer = io.BytesIO()
+    Image.fromarray(gradient.astype(np.uint8)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def request(url, body=None):
+    '''Запрос к сервису; возвращает код ответа и разобранный JSON'''
+    try:
+        with urllib.request.urlopen(url, data=body, timeout=60) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_scheme_is_rendered(server):
+    service, url = server
+    code, payload = request(
+        f"{url}/scheme?width=20&height=20&colors=3&pixel_size=5", png_bytes())
+
+    assert code == 200
+    for name in ('scheme', 'legend'):
+        image = Image.open(io.BytesIO(base64.b64decode(payload[name])))
+        assert image.format == 'PNG'
+    assert Image.open(io.BytesIO(base64.b64decode(payload['scheme']))).size == (20, 20)
+    # Сетка 4 x 4 ячейки
+    assert sum(row['stitches'] for row in payload['stats']) == 16
+    assert payload['stats_csv'].startswith('index,dmc,rgb,stitches')
+
+    code, status = request(f"{url}/status")
+    assert code == 200
+    assert status['completed'] >= 1
+    assert status['latency_p50_ms'] is not None
+
+
+def test_full_queue_is_rejected(server):
+    service, url = server
+    with service.slot():
+        code, payload = request(
+            f"{url}/scheme?width=20&height=20&colors=3", png_bytes())
+    assert code == 503
+    assert request(f"{url}/status")[1]['rejected'] >= 1
+
+
+@pytest.mark.parametrize('query', [
+    'width=200&height=200&colors=3',
+    'width=20&height=20&colors=64',
+    'width=20&height=20',
+])
+def test_invalid_parameters_are_rejected(server, query):
+    service, url = server
+    code, payload = request(f"{url}/scheme?{query}", png_bytes())
+    assert code == 400
+    assert 'error' in payload
+
+
+def huge_png_header(width, height):
+    '''PNG с огромными размерами в заголовке и без настоящих пикселей'''
+    data = png_bytes(1, 1)
+    ihdr = b'IHDR' + struct.pack('>II', width, height) + data[24:29]
+    return (data[:12] + ihdr + struct.pack('>I', zlib.crc32(ihdr))
+            + data[33:])
+
+
+@pytest.mark.parametrize('body', [
+    b'not an image',
+    png_bytes()[:100],
+    huge_png_header(20000, 20000),
+    huge_png_header(5000, 5000),
+], ids=['garbage', 'truncated', 'decompression-bomb', 'over-source-limit'])
+def test_unreadable_image_is_rejected(server, body):
+    service, url = server
+    code, payload = request(
+        f"{url}/scheme?width=20&height=20&colors=3", body)
+    assert code == 400
+
+
+def test_broken_pool_is_replaced(server):
+    service, url = server
+    # Гибель рабочего процесса ломает пул целиком
+    with pytest.raises(Exception):
+        service.executor.submit(os._exit, 1).result()
+
+    # Новый запрос после сбоя выполняется уже на заменённом пуле
+    code, payload = request(
+        f"{url}/scheme?width=20&height=20&colors=3&pixel_size=5", png_bytes())
+    assert code == 200
+    assert request(f"{url}/status")[1]['pool_restarts'] == 1
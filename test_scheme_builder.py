@@ -0,0 +1,161 @@
+import io
+import tracemalloc
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import scheme_builder
+from scheme_builder import SchemeBuilder
+
+
+def mean_cell_colors(img_array, pixel_size):
+    '''Эталон: усреднение каждой ячейки через np.mean, как в исходной версии'''
+    height, width = img_array.shape[:2]
+    return np.array([[np.mean(img_array[y:y+pixel_size, x:x+pixel_size],
+                              axis=(0, 1)).astype(int)
+                      for x in range(0, width, pixel_size)]
+                     for y in range(0, height, pixel_size)])
+
+
+@pytest.mark.parametrize('pixel_size', [1, 3, 7])
+@pytest.mark.parametrize('one_row_bands', [False, True])
+def test_cell_colors_match_per_cell_mean(pixel_size, one_row_bands):
+    rng = np.random.default_rng(1)
+    # Размеры не кратны размеру пикселя, поэтому крайние ячейки неполные
+    img_array = rng.integers(0, 256, size=(53, 61, 3), dtype=np.uint8)
+
+    builder = SchemeBuilder(pixel_size=pixel_size, memory_budget_mb=1)
+    if one_row_bands:
+        # Бюджет меньше одной строки сумм: каждая полоса содержит одну строку ячеек
+        builder.memory_budget = 1
+
+    cell_colors = builder.compute_cell_colors(img_array)
+
+    assert cell_colors.dtype == np.uint8
+    np.testing.assert_array_equal(
+        cell_colors, mean_cell_colors(img_array, pixel_size))
+
+
+def test_fit_palette_subsamples_under_small_budget(monkeypatch):
+    fitted = []
+
+    class RecordingKMeans(scheme_builder.KMeans):
+        def fit(self, X, *args, **kwargs):
+            fitted.append(X)
+            return super().fit(X, *args, **kwargs)
+
+    monkeypatch.setattr(scheme_builder, 'KMeans', RecordingKMeans)
+
+    rng = np.random.default_rng(2)
+    img_array = rng.integers(0, 256, size=(300, 300, 3), dtype=np.uint8)
+    builder = SchemeBuilder(memory_budget_mb=1)
+
+    palette = builder.fit_palette(img_array, 4)
+
+    assert len(palette) == 4
+    samples = fitted[0]
+    assert samples.dtype == np.float32
+    # 1 МБ за вычетом 256 КБ постоянной части, по 79 байт на пиксель при 4 цветах
+    assert len(samples) == 9954
+
+
+@pytest.mark.parametrize('budget_mb, color_count', [(1, 4), (1, 16), (4, 64)])
+def test_fit_palette_peak_memory_within_budget(budget_mb, color_count):
+    rng = np.random.default_rng(3)
+    img_array = rng.integers(0, 256, size=(600, 600, 3), dtype=np.uint8)
+    builder = SchemeBuilder(memory_budget_mb=budget_mb)
+
+    tracemalloc.start()
+    try:
+        builder.fit_palette(img_array, color_count)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert peak <= builder.memory_budget
+
+
+def test_source_is_released_before_clustering(monkeypatch):
+    rng = np.random.default_rng(4)
+    source = Image.fromarray(
+        rng.integers(0, 256, size=(200, 300, 3), dtype=np.uint8)).convert('P')
+    fit_palette = SchemeBuilder.fit_palette
+
+    def checked_fit_palette(builder, img_array, color_count):
+        # Закрытый исходник больше не держит раскодированные пиксели
+        with pytest.raises(ValueError):
+            source.im
+        return fit_palette(builder, img_array, color_count)
+
+    monkeypatch.setattr(SchemeBuilder, 'fit_palette', checked_fit_palette)
+    output_image, legend, stats = SchemeBuilder(pixel_size=5).build(
+        source, 30, 20, 2)
+
+    assert output_image.size == (30, 20)
+    assert sum(row.stitches for row in stats) == 6 * 4
+
+
+def test_source_over_budget_is_rejected():
+    source = Image.new('RGB', (1000, 1000))
+    with pytest.raises(scheme_builder.SourceTooLargeError):
+        SchemeBuilder(memory_budget_mb=1).build(source, 10, 10, 2)
+
+
+@pytest.mark.parametrize('dmc, expected', [
+    ('0', 'black'), ('3756', 'black'), ('3753', 'black'), ('310', 'white')])
+def test_legend_index_contrasts_with_swatch(dmc, expected):
+    color = next(rgb for rgb, code in scheme_builder.rgb_to_dmc.items()
+                 if code == dmc)
+    assert scheme_builder.contrast_text_color(color) == expected
+
+
+def test_thread_stats_count_stitches_and_export_csv():
+    labels = np.array([[0, 1, 1], [2, 1, 0]], dtype=np.uint16)
+    num_pallette = [(255, 255, 255), (0, 0, 0), (148, 91, 128)]
+    stats = SchemeBuilder().compute_thread_stats(labels, num_pallette)
+
+    assert [row.stitches for row in stats] == [2, 3, 1]
+    assert [row.dmc for row in stats] == ['0', '310', '208']
+    assert all(row.skeins_to_buy == 1 for row in stats)
+
+    stats_file = io.StringIO()
+    scheme_builder.write_stats(stats, stats_file)
+    lines = stats_file.getvalue().splitlines()
+    assert lines[0] == 'index,dmc,rgb,stitches,skeins,skeins_to_buy'
+    assert lines[2].startswith('1,310,#000000,3,')
+
+
+@pytest.mark.parametrize('color_count, columns', [(60, 5), (63, 5), (1, 1)])
+def test_legend_wraps_into_rows(color_count, columns):
+    stats = [scheme_builder.ThreadStats(
+        index=i, dmc=dmc, rgb=rgb, stitches=10, skeins=0.1, skeins_to_buy=1)
+        for i, (rgb, dmc) in enumerate(list(scheme_builder.rgb_to_dmc.items())[:color_count])]
+
+    legend = SchemeBuilder().build_legend(stats)
+
+    rows = -(-color_count // scheme_builder.LEGEND_COLUMNS)
+    assert legend.size == (columns * scheme_builder.LEGEND_CELL_WIDTH,
+                           rows * scheme_builder.LEGEND_CELL_HEIGHT)
+    # Последний цвет попадает в последнюю строку таблицы
+    last = stats[-1]
+    x = (last.index % columns) * scheme_builder.LEGEND_CELL_WIDTH + 20
+    y = (rows - 1) * scheme_builder.LEGEND_CELL_HEIGHT + 25
+    assert legend.getpixel((x, y)) == last.rgb
+
+
+def test_fallback_font_follows_requested_size(monkeypatch):
+    truetype = scheme_builder.ImageFont.truetype
+
+    def missing_truetype(font, *args, **kwargs):
+        # Хост без Arial: встроенный шрифт PIL по-прежнему доступен
+        if font == "arial.ttf":
+            raise OSError("cannot open resource")
+        return truetype(font, *args, **kwargs)
+
+    monkeypatch.setattr(scheme_builder.ImageFont, 'truetype', missing_truetype)
+
+    small = scheme_builder.load_font(2)
+    large = scheme_builder.load_font(20)
+    assert small.getbbox('8')[3] < large.getbbox('8')[3]
+    assert small.getbbox('8')[3] <= 5